@@ -1,19 +1,52 @@
 import os
+import hashlib
 import logging
-import re
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 import streamlit as st
 from dotenv import load_dotenv
 import openai
-from auth import login_user, register_user, get_user_by_id, update_openai_api_key, get_openai_api_key
 
-# Basic Logging Setup
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Basic Logging Setup (set LOG_LEVEL=DEBUG to log raw and parsed AI responses).
+# Done before importing auth so its import-time warnings use this configuration;
+# an unrecognized LOG_LEVEL falls back to WARNING rather than failing at import.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):
+    LOG_LEVEL = "WARNING"
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
+
+from config import env_int
+from auth import login_user, register_user, get_user_by_id, update_openai_api_key, get_openai_api_key, get_cached_response, save_cached_response, RESPONSE_CACHE_TTL_DAYS
 
 # Load environment variables (for fallback only)
 load_dotenv()
 
 # --- Configuration ---
 DEFAULT_OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# gpt-4o-mini supports OpenAI's automatic prompt caching, but only for prompts of
+# 1024+ tokens; ours is ~100 tokens, so today this is just a cheaper/faster model
+OPENAI_MODEL = "gpt-4o-mini"
+# Bump when the prompts change so cached responses are invalidated
+PROMPT_VERSION = 1
+RESPONSE_CACHE_SIZE = 512
+# Concurrent OpenAI calls across all sessions; each call holds a worker for the whole
+# stream, so once this many are in flight further requests queue behind them
+OPENAI_MAX_WORKERS = env_int("OPENAI_MAX_WORKERS", 16, minimum=1)
+
+# Prompts are module constants so the system prefix stays byte-identical between
+# calls (required for OpenAI prompt caching); edit them together with PROMPT_VERSION
+_SYSTEM_PROMPT = """You are Em, a supportive, non-judgmental AI assistant for users with ADHD. Your goal is to help users start tasks they feel overwhelmed by. Be gentle, understanding, sincere, and focus on breaking things down into 3-5 small, concrete, actionable first steps. Avoid demanding or overly cheerful language."""
+
+_USER_PROMPT_TMPL = """I'm feeling overwhelmed by this task: '{task}'.
+
+Can you help me figure out just the first few steps to get started? Keep it simple and clear. Please list the steps first (maybe numbered or bulleted). After the steps, please provide a separate, brief (1-2 sentences) encouraging thought focused specifically on tackling the very first step you listed. Sound sincere and understanding."""
+
+# Bullet markers recognised when parsing the AI response
+_BULLET_CHARS = ('*', '-', '+')
+_STEP_DIGITS = ('1', '2', '3', '4', '5', '6', '7', '8', '9')
 
 def get_user_api_key():
     """Get the API key for the current user or fall back to environment variable."""
@@ -24,73 +57,235 @@ def get_user_api_key():
     return DEFAULT_OPENAI_API_KEY
 
 # --- AI Helper Function ---
-def get_ai_decomposition(task_description):
-    """Calls the OpenAI API with updated prompt for natural output."""
-    api_key = get_user_api_key()
-    if not api_key:
-        logging.error("No OpenAI API Key available")
-        return None
+def _is_bullet(line):
+    """Check whether a line starts with a "1." / "1)" or "*", "-", "+" list marker.
 
-    # Configure OpenAI client with user's API key
-    openai.api_key = api_key
+    The marker must be followed by whitespace on the same line, so a bare "1." or
+    "-" line is not a bullet (the old regex let that whitespace span the newline).
+    """
+    s = line.lstrip()
+    if s[:1] in _BULLET_CHARS:
+        marker_len = 1
+    elif s[:1] in _STEP_DIGITS and s[1:2] in ('.', ')'):
+        marker_len = 2
+    else:
+        return False
+    return s[marker_len:marker_len + 1].isspace()
 
-    system_prompt = """You are Em, a supportive, non-judgmental AI assistant for users with ADHD. Your goal is to help users start tasks they feel overwhelmed by. Be gentle, understanding, sincere, and focus on breaking things down into 3-5 small, concrete, actionable first steps. Avoid demanding or overly cheerful language."""
+def _parse_ai_response(message_content):
+    """Split the raw AI response into steps and encouragement.
 
-    user_prompt = f"""I'm feeling overwhelmed by this task: '{task_description}'.
+    Lines are rejoined with plain newlines, so CRLF line endings are normalized in
+    the output.
+    """
+    steps = "Could not identify clear steps in the response."
+    encouragement = "Remember, just starting is a win!"
 
-Can you help me figure out just the first few steps to get started? Keep it simple and clear. Please list the steps first (maybe numbered or bulleted). After the steps, please provide a separate, brief (1-2 sentences) encouraging thought focused specifically on tackling the very first step you listed. Sound sincere and understanding."""
+    # Single pass: collect blank-line separated paragraphs and the first run of
+    # bullet lines (blank lines between bullets do not end the run)
+    paragraphs = []
+    current = []
+    step_lines = []
+    pending_blanks = []
+    in_steps = False
+    steps_done = False
+    for line in message_content.splitlines():
+        if not line.strip():
+            if current:
+                paragraphs.append("\n".join(current).strip())
+                current = []
+            if in_steps:
+                pending_blanks.append(line)
+            continue
+        current.append(line)
+        if _is_bullet(line):
+            if in_steps:
+                step_lines.extend(pending_blanks)
+                step_lines.append(line)
+            elif not steps_done:
+                in_steps = True
+                step_lines.append(line)
+            pending_blanks = []
+        elif in_steps:
+            in_steps = False
+            steps_done = True
+    if current:
+        paragraphs.append("\n".join(current).strip())
+    step_match = bool(step_lines)
 
-    try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=300,
-            temperature=0.7,
-            top_p=0.95,
-            frequency_penalty=0,
-            presence_penalty=0
-        )
-        
-        message_content = response.choices[0].message.content.strip()
-        logging.info(f"Raw AI Response: {message_content}")
-
-        # --- Parsing Logic ---
-        steps = "Could not identify clear steps in the response."
-        encouragement = "Remember, just starting is a win!"
-        step_pattern = r"^(?:\s*(?:[1-9][.)]|[*\-+])\s+.*(?:\n|$))+"
-        step_match = re.search(step_pattern, message_content, re.MULTILINE)
-        paragraphs = re.split(r'\n\s*\n', message_content)
-        paragraphs = [p.strip() for p in paragraphs if p.strip()]
-
-        if step_match and len(paragraphs) > 1:
-            steps = step_match.group(0).strip()
-            potential_encouragement = paragraphs[-1]
-            if not re.match(r"^\s*(?:[1-9][.)]|[*\-+])\s+", potential_encouragement):
-                encouragement = potential_encouragement
-            else: 
-                encouragement = "Focus on that first step, you can do it!"
-        elif len(paragraphs) > 1:
-            steps = "\n\n".join(paragraphs[:-1])
-            encouragement = paragraphs[-1]
-        elif len(paragraphs) == 1:
-            if step_match: 
-                steps = message_content
-                encouragement = "Just taking the first step is progress!"
-            else: 
-                steps = "No specific steps identified."
-                encouragement = message_content
+    if step_match and len(paragraphs) > 1:
+        steps = "\n".join(step_lines).strip()
+        potential_encouragement = paragraphs[-1]
+        if not _is_bullet(potential_encouragement):
+            encouragement = potential_encouragement
         else: 
-            logging.warning("Could not parse steps/encouragement.")
+            encouragement = "Focus on that first step, you can do it!"
+    elif len(paragraphs) > 1:
+        steps = "\n\n".join(paragraphs[:-1])
+        encouragement = paragraphs[-1]
+    elif len(paragraphs) == 1:
+        if step_match: 
             steps = message_content
-            encouragement = "Remember to take it one step at a time."
+            encouragement = "Just taking the first step is progress!"
+        else: 
+            steps = "No specific steps identified."
+            encouragement = message_content
+    else: 
+        logging.warning("Could not parse steps/encouragement.")
+        steps = message_content
+        encouragement = "Remember to take it one step at a time."
 
-        logging.info(f"Parsed Steps:\n{steps}")
-        logging.info(f"Parsed Encouragement:\n{encouragement}")
-        return {"steps": steps, "encouragement": encouragement}
-        
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Parsed Steps:\n%s", steps)
+        logging.debug("Parsed Encouragement:\n%s", encouragement)
+    return {"steps": steps, "encouragement": encouragement}
+
+# Bounded so rotated or one-off user keys don't keep clients alive forever
+@st.cache_resource(show_spinner=False, max_entries=64, ttl=3600)
+def get_openai_client(api_key):
+    """Get a shared OpenAI client per API key so its connection pool stays warm across reruns."""
+    return openai.OpenAI(api_key=api_key)
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    """Get the in-process LRU of parsed responses and its lock.
+
+    Held in st.cache_resource because Streamlit re-executes this script on every
+    rerun, which would rebuild a plain module-level cache each time.
+    """
+    return OrderedDict(), threading.Lock()
+
+@st.cache_resource(show_spinner=False)
+def get_executor():
+    """Get the shared worker pool that runs OpenAI calls off the script thread."""
+    return ThreadPoolExecutor(max_workers=OPENAI_MAX_WORKERS, thread_name_prefix="openai")
+
+def _decompose(client, response_cache, task_description, on_text=None):
+    """Decompose a task, checking the caches before calling OpenAI.
+
+    ``response_cache`` is the ``(OrderedDict, Lock)`` pair from get_response_cache().
+    On a cache miss ``on_text`` is called with the response text so far as it streams.
+    Raises on API failure so that errors are never cached.
+    """
+    cache, lock = response_cache
+    # Normalize only the cache key so trivially different spellings of a task share
+    # an entry; the model still sees the task as the user typed it
+    cache_key = " ".join(task_description.split()).lower()
+    task_hash = hashlib.sha256(
+        f"{PROMPT_VERSION}:{OPENAI_MODEL}:{cache_key}".encode('utf-8')
+    ).hexdigest()
+    now = time.time()
+    with lock:
+        entry = cache.get(task_hash)
+        if entry and now - entry[0] < RESPONSE_CACHE_TTL_DAYS * 86400:
+            cache.move_to_end(task_hash)
+            return entry[1]
+
+    stored_at = now
+    stored = get_cached_response(task_hash)
+    if stored:
+        logging.info("Using cached AI response")
+        # Age the memory entry from when the row was stored, so the TTL isn't restarted
+        stored_at = stored.pop("created_at")
+        result = stored
+    else:
+        result, complete = _stream_openai(client, task_description, on_text)
+        # Don't pin an empty or truncated generation to this task for every user
+        if not complete:
+            return result
+        save_cached_response(task_hash, result["steps"], result["encouragement"])
+
+    with lock:
+        cache[task_hash] = (stored_at, result)
+        cache.move_to_end(task_hash)
+        if len(cache) > RESPONSE_CACHE_SIZE:
+            cache.popitem(last=False)
+    return result
+
+def _stream_openai(client, task_description, on_text=None):
+    """Stream a completion from OpenAI and parse it once the stream closes.
+
+    Returns the parsed result and whether the response is complete enough to cache
+    (non-empty and finished with ``finish_reason == "stop"``).
+    """
+    user_prompt = _USER_PROMPT_TMPL.format(task=task_description)
+
+    stream = client.chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=[
+            {"role": "system", "content": _SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt}
+        ],
+        max_tokens=300,
+        temperature=0.7,
+        top_p=0.95,
+        frequency_penalty=0,
+        presence_penalty=0,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+
+    buf = ""
+    usage = None
+    finish_reason = None
+    for chunk in stream:
+        # The final chunk carries usage and no choices
+        if chunk.usage:
+            usage = chunk.usage
+        if chunk.choices:
+            choice = chunk.choices[0]
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+            buf += choice.delta.content or ""
+            if on_text is not None:
+                on_text(buf)
+
+    # Logged at INFO, so only visible with LOG_LEVEL=INFO (or DEBUG); cached stays 0
+    # until the prompt grows past the 1024-token caching minimum
+    if usage:
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", 0) or 0
+        logging.info("Prompt tokens: %s (cached: %s)", usage.prompt_tokens, cached_tokens)
+
+    message_content = buf.strip()
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Raw AI Response: %s", message_content)
+
+    complete = bool(message_content) and finish_reason == "stop"
+    if not complete:
+        logging.warning("Incomplete AI response (finish_reason=%s); not caching it", finish_reason)
+    return _parse_ai_response(message_content), complete
+
+def get_ai_decomposition(task_description, placeholder=None):
+    """Calls the OpenAI API with updated prompt for natural output.
+
+    If given, ``placeholder`` (an ``st.empty()``) shows the response while it streams.
+    """
+    api_key = get_user_api_key()
+    if not api_key:
+        logging.error("No OpenAI API Key available")
+        return None
+
+    try:
+        client = get_openai_client(api_key)
+        # The worker thread has no Streamlit context, so it hands streamed text back
+        # through a queue and this (script) thread renders it. Touching the placeholder
+        # while waiting also lets a rerun interrupt the script; the worker still
+        # finishes and fills the cache.
+        updates = queue.Queue()
+        future = get_executor().submit(
+            _decompose, client, get_response_cache(), task_description, updates.put
+        )
+        while True:
+            done, _ = wait([future], timeout=0.1)
+            text = None
+            while not updates.empty():
+                text = updates.get_nowait()
+            if text is not None and placeholder is not None:
+                placeholder.markdown(text)
+            if done:
+                break
+        return dict(future.result())
     except Exception as e:
         logging.error(f"Error during OpenAI call: {e}", exc_info=True)
         return None
@@ -205,8 +400,11 @@ def show_main_app():
         if not task_description:
             st.warning("Please enter a task description.")
         else:
+            placeholder = st.empty()
             with st.spinner("Thinking..."):
-                result = get_ai_decomposition(task_description)
+                result = get_ai_decomposition(task_description, placeholder)
+            # Swap the raw streamed text for the parsed layout
+            placeholder.empty()
                 
             if result:
                 st.subheader("Here's how we can break this down:")
@@ -1,81 +1,128 @@
 import sqlite3
+import threading
 import bcrypt
 import streamlit as st
+from contextlib import contextmanager
 from datetime import datetime
 import logging
+from config import env_int
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Logging is configured by the app (app_streamlit.py)
 logger = logging.getLogger(__name__)
 
+DB_PATH = 'users.db'
+# Bump when init_db's schema changes
+_SCHEMA_VERSION = 1
+
+# Stored AI responses older than this are ignored and purged
+RESPONSE_CACHE_TTL_DAYS = env_int("RESPONSE_CACHE_TTL_DAYS", 30, minimum=1)
+
+# bcrypt work factor; lower it on slow hardware, raise it as hardware gets faster
+# (bcrypt accepts 4-31)
+_BCRYPT_ROUNDS = env_int("BCRYPT_ROUNDS", 12, minimum=4, maximum=31)
+
+# SQL for the per-request paths. sqlite3 caches prepared statements per connection
+# keyed by the SQL text; since every thread shares the one connection from _db(),
+# each statement is parsed once per process rather than once per call.
+_SQL_INSERT_USER = 'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)'
+_SQL_LOGIN_SELECT = 'SELECT id, username, email, password_hash, created_at, last_login FROM users WHERE username = ?'
+_SQL_UPDATE_LAST_LOGIN = 'UPDATE users SET last_login = ? WHERE username = ?'
+_SQL_USER_BY_ID = 'SELECT id, username, email, created_at, last_login FROM users WHERE id = ?'
+_SQL_UPDATE_API_KEY = 'UPDATE users SET openai_api_key = ? WHERE username = ?'
+_SQL_SELECT_API_KEY = 'SELECT openai_api_key FROM users WHERE username = ?'
+_SQL_SELECT_RESPONSE = (
+    "SELECT steps, encouragement, CAST(strftime('%s', created_at) AS INTEGER) FROM responses"
+    " WHERE task_hash = ? AND created_at > datetime('now', ?)"
+)
+_SQL_PURGE_RESPONSES = "DELETE FROM responses WHERE created_at <= datetime('now', ?)"
+_SQL_UPSERT_RESPONSE = 'INSERT OR REPLACE INTO responses (task_hash, steps, encouragement) VALUES (?, ?, ?)'
+
+# One connection for the whole process. Streamlit starts a new script thread for
+# every rerun, so per-thread connections would be reopened on each click; instead
+# all threads share this one and take turns under the lock.
+_db_conn = None
+_db_lock = threading.RLock()
+
+@contextmanager
+def _db():
+    """Hold the database lock and yield the shared connection, opening it on first use."""
+    global _db_conn
+    with _db_lock:
+        if _db_conn is None:
+            conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            _db_conn = conn
+        yield _db_conn
+
 def init_db():
     """Initialize the SQLite database with users table."""
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            openai_api_key TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_login TIMESTAMP
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    with _db() as conn:
+        # Skip the DDL entirely once the schema is current
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= _SCHEMA_VERSION:
+            return
+        c = conn.cursor()
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                email TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL,
+                openai_api_key TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_login TIMESTAMP
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                task_hash TEXT PRIMARY KEY,
+                steps TEXT NOT NULL,
+                encouragement TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        c.execute(f'PRAGMA user_version = {_SCHEMA_VERSION}')
+        conn.commit()
 
 def hash_password(password):
     """Hash a password using bcrypt."""
-    salt = bcrypt.gensalt()
-    return bcrypt.hashpw(password.encode('utf-8'), salt)
+    password_bytes = password.encode('utf-8')
+    salt = bcrypt.gensalt(rounds=_BCRYPT_ROUNDS, prefix=b"2b")
+    return bcrypt.hashpw(password_bytes, salt)
 
-def verify_password(password, password_hash):
-    """Verify a password against its hash."""
-    return bcrypt.checkpw(password.encode('utf-8'), password_hash)
+def verify_password(password_bytes, password_hash):
+    """Verify UTF-8 encoded password bytes against their hash."""
+    return bcrypt.checkpw(password_bytes, password_hash)
 
 def register_user(username, email, password):
     """Register a new user."""
     try:
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        
-        # Check if username or email already exists
-        c.execute('SELECT * FROM users WHERE username = ? OR email = ?', (username, email))
-        if c.fetchone():
-            conn.close()
-            return False, "Username or email already exists"
-        
-        # Hash password and store user
+        # Hash password (outside the lock) and store user; the UNIQUE constraints
+        # reject duplicates
         password_hash = hash_password(password)
-        c.execute(
-            'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
-            (username, email, password_hash)
-        )
-        conn.commit()
-        conn.close()
+        with _db() as conn, conn:
+            conn.execute(_SQL_INSERT_USER, (username, email, password_hash))
         return True, "Registration successful"
+    except sqlite3.IntegrityError:
+        return False, "Username or email already exists"
     except Exception as e:
         logger.error(f"Registration error: {e}")
         return False, "Registration failed"
 
 def login_user(username, password):
     """Authenticate a user."""
+    password_bytes = password.encode('utf-8')
     try:
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        
         # Get user by username
-        c.execute('SELECT * FROM users WHERE username = ?', (username,))
-        user = c.fetchone()
+        with _db() as conn:
+            user = conn.execute(_SQL_LOGIN_SELECT, (username,)).fetchone()
         
-        if user and verify_password(password, user[3]):  # user[3] is password_hash
-            # Update last login
-            c.execute('UPDATE users SET last_login = ? WHERE username = ?',
-                     (datetime.now(), username))
-            conn.commit()
-            conn.close()
+        # bcrypt runs without holding the database lock
+        if user and verify_password(password_bytes, user[3]):  # user[3] is password_hash
+            # Update last login; the inner with block commits, or rolls back on error
+            with _db() as conn, conn:
+                conn.execute(_SQL_UPDATE_LAST_LOGIN, (datetime.now(), username))
             return True, {
                 "id": user[0],
                 "username": user[1],
@@ -83,7 +130,6 @@ def login_user(username, password):
                 "created_at": user[4],
                 "last_login": user[5]
             }
-        conn.close()
         return False, "Invalid username or password"
     except Exception as e:
         logger.error(f"Login error: {e}")
@@ -92,18 +138,15 @@ def login_user(username, password):
 def get_user_by_id(user_id):
     """Get user details by ID."""
     try:
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-        user = c.fetchone()
-        conn.close()
+        with _db() as conn:
+            user = conn.execute(_SQL_USER_BY_ID, (user_id,)).fetchone()
         if user:
             return {
                 "id": user[0],
                 "username": user[1],
                 "email": user[2],
-                "created_at": user[4],
-                "last_login": user[5]
+                "created_at": user[3],
+                "last_login": user[4]
             }
         return None
     except Exception as e:
@@ -113,29 +156,59 @@ def get_user_by_id(user_id):
 def update_openai_api_key(username, api_key):
     """Update user's OpenAI API key."""
     try:
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute('UPDATE users SET openai_api_key = ? WHERE username = ?',
-                 (api_key, username))
-        conn.commit()
-        conn.close()
+        with _db() as conn, conn:
+            conn.execute(_SQL_UPDATE_API_KEY, (api_key, username))
+        _fetch_openai_api_key.clear()
         return True, "API key updated successfully"
     except Exception as e:
         logger.error(f"Error updating API key: {e}")
         return False, "Failed to update API key"
 
+@st.cache_data(ttl=300, show_spinner=False)
+def _fetch_openai_api_key(username):
+    """Read user's OpenAI API key, cached across reruns until it is updated.
+
+    Errors propagate so that a failed lookup is never cached as "no key".
+    """
+    with _db() as conn:
+        result = conn.execute(_SQL_SELECT_API_KEY, (username,)).fetchone()
+    return result[0] if result else None
+
 def get_openai_api_key(username):
     """Get user's OpenAI API key."""
     try:
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute('SELECT openai_api_key FROM users WHERE username = ?', (username,))
-        result = c.fetchone()
-        conn.close()
-        return result[0] if result else None
+        return _fetch_openai_api_key(username)
     except Exception as e:
         logger.error(f"Error getting API key: {e}")
         return None
 
-# Initialize database when module is imported
+def _response_ttl_modifier():
+    """SQLite datetime() modifier for the oldest response still considered fresh."""
+    return f'-{RESPONSE_CACHE_TTL_DAYS} days'
+
+def get_cached_response(task_hash):
+    """Get a previously stored, unexpired AI decomposition by task hash.
+
+    ``created_at`` in the result is the time it was stored, in epoch seconds.
+    """
+    try:
+        with _db() as conn:
+            result = conn.execute(_SQL_SELECT_RESPONSE, (task_hash, _response_ttl_modifier())).fetchone()
+        if result:
+            return {"steps": result[0], "encouragement": result[1], "created_at": result[2]}
+        return None
+    except Exception as e:
+        logger.error(f"Error getting cached response: {e}")
+        return None
+
+def save_cached_response(task_hash, steps, encouragement):
+    """Store an AI decomposition for reuse across restarts."""
+    try:
+        with _db() as conn, conn:
+            conn.execute(_SQL_PURGE_RESPONSES, (_response_ttl_modifier(),))
+            conn.execute(_SQL_UPSERT_RESPONSE, (task_hash, steps, encouragement))
+    except Exception as e:
+        logger.error(f"Error saving cached response: {e}")
+
+# Initialize database once per process, when the module is first imported
 init_db() 
\ No newline at end of file
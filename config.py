@@ -0,0 +1,25 @@
+import os
+import logging
+
+# Module logger rather than the root logging functions, which would configure the
+# root logger as a side effect if called before the app sets logging up
+logger = logging.getLogger(__name__)
+
+def env_int(name, default, minimum=None, maximum=None):
+    """Read an integer setting from the environment.
+
+    Missing, non-integer or out-of-range values fall back to ``default`` (with a
+    warning for the latter two) so a bad setting never stops the app from starting.
+    """
+    raw = os.getenv(name)
+    if raw is None or not raw.strip():
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        logger.warning(f"{name}={raw!r} is not an integer; using {default}")
+        return default
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        logger.warning(f"{name}={value} is out of range; using {default}")
+        return default
+    return value